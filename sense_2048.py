@@ -29,33 +29,38 @@ from sense_hat import sense_hat
 
 TILE_EMPTY = 0
 
-TILE_COLORS = collections.defaultdict(
-
-    # Placeholder for undefined tile (should never appear):
-    lambda: (255, 127, 127),
-
-    {
-        TILE_EMPTY: (0, 0, 0),
-        2: (255, 255, 255),
-        4: (255, 255, 0),
-        8: (255, 127, 0),
-        16: (255, 0, 0),
-        32: (255, 0, 191),
-        64: (127, 0, 255),
-        128: (0, 0, 191),
-        256: (0, 127, 255),
-        512: (0, 255, 255),
-        1024: (0, 255, 0),
-        2048: (0, 95, 0),
-
-        4096: (0, 95, 95),
-        8192: (0, 0, 95),
-        16384: (95, 0, 95),
-        32768: (95, 0, 0),
-        65536: (95, 95, 0),
-        131072: (95, 95, 95),
-    }
-)
+# Placeholder color for undefined tile (should never appear):
+TILE_COLOR_UNDEFINED = (255, 127, 127)
+
+TILE_COLORS = {
+    TILE_EMPTY: (0, 0, 0),
+    2: (255, 255, 255),
+    4: (255, 255, 0),
+    8: (255, 127, 0),
+    16: (255, 0, 0),
+    32: (255, 0, 191),
+    64: (127, 0, 255),
+    128: (0, 0, 191),
+    256: (0, 127, 255),
+    512: (0, 255, 255),
+    1024: (0, 255, 0),
+    2048: (0, 95, 0),
+
+    4096: (0, 95, 95),
+    8192: (0, 0, 95),
+    16384: (95, 0, 95),
+    32768: (95, 0, 0),
+    65536: (95, 95, 0),
+    131072: (95, 95, 95),
+}
+
+# TILE_COLORS as an array of RGB values indexed by tile exponent (log2
+# of the tile's face value), for every exponent a uint8 tile can hold
+PALETTE = np.array(
+    [TILE_COLORS.get(1 << exponent if exponent else TILE_EMPTY,
+                     TILE_COLOR_UNDEFINED)
+     for exponent in range(256)],
+    dtype=np.uint8)
 
 ROTATIONS = {
     'left': 0,
@@ -79,6 +84,65 @@ You can also:
 
 """
 
+# Tables for shifting/merging a board row of ROW_LENGTH tiles with a
+# single lookup.  Each row is packed into a 16-bit key holding the
+# exponent (log2 of the face value) of each of its tiles in a nibble,
+# first tile in the most significant nibble.  Rows of other lengths or
+# with tiles too large to fit (or to merge into a tile that fits) are
+# processed directly instead.  ROW_LENGTH nibbles must fill the 16-bit
+# key exactly, so the tables only cover rows of 4 tiles.
+ROW_LENGTH = 4
+MAX_PACKED_EXPONENT = 14
+_NIBBLE_SHIFTS = np.arange(ROW_LENGTH - 1, -1, -1, dtype=np.uint16) * 4
+
+
+def _row_keys(rows):
+    # Pack each row of 2D array *rows* of tile exponents into a 16-bit
+    # table key
+    return np.bitwise_or.reduce(
+        rows.astype(np.uint16) << _NIBBLE_SHIFTS, axis=1)
+
+
+def _unpacked_rows(keys):
+    # Inverse of _row_keys()
+    return ((keys[:, np.newaxis] >> _NIBBLE_SHIFTS) & 0xF).astype(np.uint8)
+
+
+def _is_packable(rows):
+    # Return True if all of *rows* can be shifted and merged through the
+    # row tables
+    return (rows.shape[1] == ROW_LENGTH
+            and rows.max() <= MAX_PACKED_EXPONENT)
+
+
+def _shifted_rows(rows):
+    # Return a copy of 2D array *rows* of tile exponents with the tiles
+    # in each row slid as far as possible toward the start of the row
+    order = np.argsort(rows == TILE_EMPTY, axis=1, kind='stable')
+    return np.take_along_axis(rows, order, axis=1)
+
+
+def _merged_rows(rows):
+    # Return a copy of 2D array *rows* of tile exponents with each pair
+    # of adjacent matching tiles, searched from the start of the row,
+    # replaced with a tile of the next exponent and an empty space.  Also
+    # return an array of the scoring value of each row's merges.
+    rows = rows.copy()
+    scores = np.zeros(len(rows), dtype=np.int64)
+    for i in range(rows.shape[1] - 1):
+        matches = (rows[:, i] == rows[:, i+1]) & (rows[:, i] != TILE_EMPTY)
+        rows[matches, i] += 1
+        rows[matches, i+1] = TILE_EMPTY
+        scores[matches] += 1 << rows[matches, i].astype(np.int64)
+    return rows, scores
+
+
+_ALL_ROWS = _unpacked_rows(np.arange(1 << 16, dtype=np.uint16))
+SHIFT_TABLE = _row_keys(_shifted_rows(_ALL_ROWS))
+MERGE_TABLE, MERGE_SCORE_TABLE = _merged_rows(_ALL_ROWS)
+MERGE_TABLE = _row_keys(MERGE_TABLE)
+del _ALL_ROWS
+
 
 class Board:
     """Object representing the game board with its tiles.
@@ -90,6 +154,13 @@ class Board:
     of the board state.)  Tiles are indicated by ints representing the
     tile's face value.  TILE_EMPTY indicates no tile in that space.
 
+    tile_exponents:  Like *tiles*, but tiles are indicated by the
+    exponent of their face value (1 for 2, 2 for 4, etc.)  This
+    returns a read-only view rather than a copy, for cheap access on
+    hot paths.  The view keeps showing the tiles as they were when it
+    was taken through shift(), merge() and set_state(), which replace
+    the board's tile array; only place_tile() changes it in place.
+
     score:  The game's current score, calculated as the sum of the
     values of all tiles created through merging of two matching tiles
     """
@@ -104,42 +175,62 @@ class Board:
         each turn
         """
         self._size = size
-        self._new_tile_vals = new_tile_vals
-
-        self._tiles = np.full(self._size, TILE_EMPTY)
+        self._new_tile_exponents = [
+            value.bit_length() - 1 for value in new_tile_vals]
+
+        # Tiles are stored internally as the exponent of their face
+        # value (2 → 1, 4 → 2, ...), with TILE_EMPTY for empty spaces
+        self._tiles = np.full(self._size, TILE_EMPTY, dtype=np.uint8)
+
+        # For each direction, the flat indices of the board's spaces
+        # arranged in rows running away from the side tiles are shifted
+        # toward, so moves can gather and scatter rows directly
+        flat_indices = np.arange(self._tiles.size).reshape(self._size)
+        self._direction_indices = {
+            direction: np.rot90(flat_indices, rotation).copy()
+            for direction, rotation in ROTATIONS.items()
+        }
         self.score = 0
         self._random = random.Random()
+        self._rng_state = None
+        self._has_moves = None
 
         self.place_tile()
         self.place_tile()
 
     @property
     def tiles(self):
-        return self._tiles.copy()
+        return np.where(self._tiles == TILE_EMPTY, TILE_EMPTY,
+                        1 << self._tiles.astype(np.int64))
+
+    @property
+    def tile_exponents(self):
+        tiles = self._tiles.view()
+        tiles.flags.writeable = False
+        return tiles
 
     def place_tile(self):
         """Place a randomly-selected tile in a random vacant space on the board
         if space is available.
         """
-        new_tile = self._random.choice(self._new_tile_vals)
-        try:
-            coord = tuple(self._random.choice(
-                np.argwhere(self._tiles == TILE_EMPTY)))
-        except IndexError:
-            pass
-        else:
-            self._tiles[coord] = new_tile
+        new_tile = self._random.choice(self._new_tile_exponents)
+        self._rng_state = None
+        empties = np.flatnonzero(self._tiles == TILE_EMPTY)
+        if empties.size:
+            index = empties[self._random.randrange(empties.size)]
+            self._tiles.flat[index] = new_tile
+            self._has_moves = None
 
     def shift(self, direction):
         """Shift all tiles in the given direction 'up', 'down', 'left', or
         'right' as far as possible.
         """
-        tiles = np.rot90(self._tiles, ROTATIONS[direction])
-        for i, row in enumerate(tiles):
-            tiles[i] = np.concatenate(
-                (row[row != TILE_EMPTY], row[row == TILE_EMPTY])
-            )
-        self._tiles = np.rot90(tiles, -ROTATIONS[direction])
+        tiles = self._rows(direction)
+        if _is_packable(tiles):
+            tiles = _unpacked_rows(SHIFT_TABLE[_row_keys(tiles)])
+        else:
+            tiles = _shifted_rows(tiles)
+        self._set_rows(direction, tiles)
 
     def merge(self, direction):
         """Search for pairs of adjacent matching tiles that would bump against
@@ -149,19 +240,29 @@ class Board:
         scoring value of the merges (the sum of all newly created
         tiles).
         """
-        tiles = np.rot90(self._tiles, ROTATIONS[direction])
-        for row in tiles:
-            for i in range(len(row) - 1):
-                if row[i] == row[i+1] and row[i] != TILE_EMPTY:
-                    new_tile = row[i] * 2
-                    self.score += new_tile
-                    row[i], row[i+1] = new_tile, TILE_EMPTY
-        self._tiles = np.rot90(tiles, -ROTATIONS[direction])
+        tiles = self._rows(direction)
+        if _is_packable(tiles):
+            keys = _row_keys(tiles)
+            self.score += int(MERGE_SCORE_TABLE[keys].sum())
+            tiles = _unpacked_rows(MERGE_TABLE[keys])
+        else:
+            tiles, scores = _merged_rows(tiles)
+            self.score += int(scores.sum())
+        self._set_rows(direction, tiles)
 
     def has_moves(self):
         """Return True if legal moves are possible, False if there are no moves
         left and the game is over.
         """
+        # The answer only changes when the tiles do, so it is cached
+        # until then
+        if self._has_moves is None:
+            self._has_moves = bool(self._find_moves())
+        return self._has_moves
+
+    def _find_moves(self):
+        # Uncached implementation of has_moves()
+
         # Moving is possible if there are vacant spaces on the board
         if np.any(self._tiles == TILE_EMPTY):
             return True
@@ -172,24 +273,45 @@ class Board:
             or np.any(self._tiles[:-1, :] == self._tiles[1:, :])  # Vertical
         )
 
+    def _rows(self, direction):
+        # Return a copy of the board's tiles arranged in rows running
+        # away from the side of the board in the given direction
+        return self._tiles.take(self._direction_indices[direction])
+
+    def _set_rows(self, direction, rows):
+        # Replace the board's tiles with *rows* arranged as returned by
+        # _rows() for the same direction.  This must allocate a new
+        # array rather than write into the old one, since callers rely
+        # on earlier tile_exponents views keeping the previous tiles.
+        tiles = np.empty(self._size, dtype=np.uint8)
+        np.put(tiles, self._direction_indices[direction], rows)
+        # Keep the cached has_moves() result through moves that change
+        # nothing, such as rejected moves
+        if tiles.tobytes() != self._tiles.tobytes():
+            self._has_moves = None
+        self._tiles = tiles
+
     def get_state(self):
         """Return an object that can be later passed to *set_state()* to restore
         the complete board state to what it was when the call to
         *get_state()* was made.
         """
-        return {
-            'tiles': self.tiles,
-            'score': self.score,
-            'rng': self._random.getstate()
-        }
+        # The random generator is only advanced by place_tile(), so its
+        # state is captured at most once between placements
+        if self._rng_state is None:
+            self._rng_state = self._random.getstate()
+        return (self._tiles.tobytes(), self.score, self._rng_state)
 
     def set_state(self, state):
         """Restore the board state with a state object retrieved from
         *get_state()*.
         """
-        self._tiles = state['tiles']
-        self.score = state['score']
-        self._random.setstate(state['rng'])
+        tiles, self.score, rng_state = state
+        self._tiles = np.frombuffer(tiles, dtype=np.uint8).reshape(
+            self._size).copy()
+        self._random.setstate(rng_state)
+        self._rng_state = rng_state
+        self._has_moves = None
 
 
 class UI:
@@ -212,6 +334,9 @@ class UI:
     fade_animation_steps:  Number of frames to generate for the
     tile-fade/dissolve effect
 
+    fade_dots_per_frame:  Number of pixels to turn off in each frame of
+    the end-of-game dissolve effect
+
     scroll_rate:  Text scroll speed for SenseHAT.show_message()
     """
 
@@ -223,6 +348,8 @@ class UI:
 
     fade_animation_steps = 8
 
+    fade_dots_per_frame = 4
+
     scroll_rate = 1 / 18
 
     def __init__(self, hat):
@@ -231,9 +358,33 @@ class UI:
         """
         self._hat = hat
 
+        # Copy of what is currently on the HAT's LED matrix, kept
+        # up to date by _set_display() so that animations don't need to
+        # read the display back from the HAT
+        self._current_display = self._get_display()
+
+        # Scratch buffer for rendering animation frames
+        self._frame_buffer = np.empty((8, 8, 3), dtype=np.uint8)
+
+        # Frames are written straight to the HAT's framebuffer,
+        # skipping set_pixels()'s per-pixel validation and packing.
+        # This is the framebuffer device on real hardware, or the
+        # emulator's shared-memory screen file.  It is opened for update
+        # without truncation, as sense_hat and sense_emu do: the
+        # emulator's file has a gamma table after the pixel data.
+        fb_device = getattr(hat, '_fb_device', None)
+        self._framebuffer = (
+            open(fb_device, 'rb+', buffering=0) if fb_device else None)
+
         # Initialize game-specific instance attributes
         self.new_game()
 
+    def close(self):
+        """Release the HAT framebuffer opened for drawing."""
+        if self._framebuffer is not None:
+            self._framebuffer.close()
+            self._framebuffer = None
+
     def new_game(self):
         """Reset the board and start a new game."""
         self.board = Board()
@@ -265,7 +416,9 @@ class UI:
                 if event.direction in ['left', 'right', 'up', 'down']:
                     return event.direction
                 if event.direction == 'middle':
-                    middle_hold_start = time.time()
+                    # Time the hold with the joystick's own timestamps
+                    # rather than reading the clock here
+                    middle_hold_start = event.timestamp
 
             if middle_hold_start is not None and event.direction == 'middle':
                 if (event.action == 'held' and
@@ -303,31 +456,30 @@ class UI:
         # Save current states for undo and to check afterward if move
         # was successful
         undo_state = self.board.get_state()
-        orig_tiles = self.board.tiles
+        orig_tiles = self.board.tile_exponents
 
         # Shift board tiles in the requested direction
         self._animate_shift(direction)
         self.board.shift(direction)
 
-        # Merge any matching tiles, animate if anything changed, and
-        # display current score on console
-        unmerged_tiles = self.board.tiles
+        # Merge any matching tiles.  If anything merged, animate the
+        # change, display current score on console, and shift board
+        # again to fill in the gaps left behind.  (With no merges there
+        # are no gaps, so the second shift is skipped.)
+        unmerged_tiles = self.board.tile_exponents
         orig_score = self.board.score
         self.board.merge(direction)
-        if not np.array_equal(unmerged_tiles, self.board.tiles):
-            self._animate_changed(unmerged_tiles, self.board.tiles)
         if self.board.score != orig_score:
+            self._animate_changed(unmerged_tiles, self.board.tile_exponents)
             self.print_score()
-
-        # Shift board again to fill in any leftover gaps
-        self._animate_shift(direction)
-        self.board.shift(direction)
+            self._animate_shift(direction)
+            self.board.shift(direction)
 
         # Check if anything actually changed.  If so, end the turn by
         # placing a random tile on the board and fading it in and
         # pushing the last board state to the undo stack.  Otherwise,
         # perform an ”error” flash and abort.
-        if not np.array_equal(orig_tiles, self.board.tiles):
+        if not np.array_equal(orig_tiles, self.board.tile_exponents):
             self._undo_stack.append(undo_state)
             self.board.place_tile()
             self.show_board()
@@ -355,15 +507,16 @@ class UI:
             best_tile,
             self.board.score,
         )
-        text_color = TILE_COLORS[best_tile]
+        text_color = PALETTE[np.max(self.board.tile_exponents)].tolist()
         self._hat.show_message(
             hat_msg, text_colour=text_color, scroll_speed=self.scroll_rate)
+        self._current_display = self._get_display()
 
         self.show_board()
 
     def show_board(self):
         """Display current state of game board on the Sense HAT."""
-        self._fade_to(self._rendered_board(self.board.tiles))
+        self._fade_to(self._rendered_board(self.board.tile_exponents))
 
     def print_score(self):
         """Print current player score on console."""
@@ -371,15 +524,26 @@ class UI:
               end='\r')
 
     @staticmethod
-    def _rendered_board(tiles):
+    def _scaled_board(tiles):
+        # Return an 8×8 array of the per-tile values in array *tiles*
+        # (tile exponents or RGB components) as they map onto the LED
+        # matrix's pixels
+
+        # Each tile becomes a scale_x×scale_y block, filled in with one
+        # broadcast assignment into a block view of the result
+        dim_x, dim_y = tiles.shape[:2]
+        scale_x, scale_y = 8 // dim_x, 8 // dim_y
+        scaled = np.empty((8, 8) + tiles.shape[2:], dtype=tiles.dtype)
+        scaled.reshape((dim_x, scale_x, dim_y, scale_y) + tiles.shape[2:])[
+            ...] = tiles[:, np.newaxis, :, np.newaxis]
+        return scaled
+
+    @classmethod
+    def _rendered_board(cls, tiles):
         # Return a 3D array of pixels (8 rows, 8 cols, 3 RGB components)
-        # representing the game board's tiles
-
-        dim_x, dim_y = tiles.shape
-        scaled = tiles.repeat(8 / dim_x, axis=0).repeat(8 / dim_y, axis=1)
-        return np.array(
-            [[TILE_COLORS[tile] for tile in row] for row in scaled],
-            dtype=np.uint8)
+        # representing the game board's tiles, given as an array of
+        # tile exponents
+        return cls._scaled_board(PALETTE[tiles])
 
     def _get_display(self):
         # Retrieve display from Sense HAT, converted to Numpy 8×8×3
@@ -389,11 +553,31 @@ class UI:
             np.array(self._hat.get_pixels()), (8, 8, 3)
         ).astype(np.uint8)
 
-    def _set_display(self, pixel_array):
-        # Send 8×8×3 pixel array to Sense HAT's LED matrix
-        self._hat.set_pixels(
-            [tuple(pixel) for row in pixel_array for pixel in row]
-        )
+    def _set_display(self, pixel_array, packed=None):
+        # Send 8×8×3 pixel array to Sense HAT's LED matrix.  *packed*
+        # may give pixel_array already converted by _rgb565(), for
+        # callers that pack several frames at once.
+        self._current_display[...] = pixel_array
+        if self._framebuffer is None:
+            self._hat.set_pixels(
+                self._current_display.reshape(-1, 3).tolist())
+        else:
+            if packed is None:
+                packed = self._rgb565(self._current_display)
+            # The game never rotates the display, so pixels are stored
+            # in the framebuffer in row order
+            self._framebuffer.seek(0)
+            self._framebuffer.write(packed.tobytes())
+
+    @staticmethod
+    def _rgb565(pixel_array):
+        # Return an array of pixel_array's RGB pixels packed into the
+        # Sense HAT framebuffer's 16-bit 5-6-5 format
+
+        pixels = pixel_array.astype(np.uint16)
+        return (((pixels[..., 0] >> 3) << 11)
+                | ((pixels[..., 1] >> 2) << 5)
+                | (pixels[..., 2] >> 3))
 
     def _animate_shift(self, direction):
         # Visually shift the tiles on the HAT screen in the given
@@ -401,31 +585,42 @@ class UI:
         # Board object should be sent its own shift command in order to
         # ensure its tiles match the resulting screen state.
 
-        display = self._get_display()
+        # Work on the board's tiles at display resolution, so that no
+        # pixels need to be read back or compared by color.  *rows* is
+        # a rotated view of *display_tiles*, so sliding its rows toward
+        # their starts moves the tiles in the given direction.
+        display_tiles = self._scaled_board(self.board.tile_exponents)
+        rows = np.rot90(display_tiles, ROTATIONS[direction])
+        columns = np.arange(rows.shape[1])
 
         while True:
             # Slide pixels representing tiles over by one wherever there
-            # are empty pixels to slide into
-            rotated_display = np.rot90(display.copy(), ROTATIONS[direction])
-            for row in rotated_display:
-                for j in range(len(row) - 1):
-                    if np.array_equal(row[j], TILE_COLORS[TILE_EMPTY]):
-                        row[[j, j+1]] = row[[j+1, j]]
-            new_display = np.rot90(rotated_display, -ROTATIONS[direction])
-
-            # Keep going until no pixels have succeeded in moving any further
-            if np.array_equal(new_display, display):
+            # are empty pixels to slide into, i.e. every pixel past the
+            # first empty pixel in its row
+            empty = rows == TILE_EMPTY
+            first_empty = np.where(
+                empty.any(axis=1), empty.argmax(axis=1), len(columns))
+            sliding = columns >= first_empty[:, np.newaxis]
+
+            # Keep going until no pixels can move any further
+            if not (sliding & ~empty).any():
                 break
 
-            # Render frame to screen
-            self._set_display(new_display)
-            display = new_display
+            rows[:, :-1] = np.where(sliding[:, :-1], rows[:, 1:], rows[:, :-1])
+            rows[sliding[:, -1], -1] = TILE_EMPTY
+
+            # Render frame to screen.  (Every uint8 tile exponent is a
+            # valid PALETTE index, so mode='clip' never clips anything,
+            # but it lets take() write to the buffer directly.)
+            np.take(PALETTE, display_tiles,
+                    axis=0, out=self._frame_buffer, mode='clip')
+            self._set_display(self._frame_buffer)
             time.sleep(self.animation_rate)
 
     def _animate_changed(self, old_tiles, new_tiles):
-        # Given two arrays of board tiles, render a fade-out effect for
-        # the on-screen tiles that have changed between the arrays, then
-        # fade in the new tiles from new_tiles.
+        # Given two arrays of board tile exponents, render a fade-out
+        # effect for the on-screen tiles that have changed between the
+        # arrays, then fade in the new tiles from new_tiles.
 
         faded_display = self._rendered_board(
             (old_tiles == new_tiles) * old_tiles
@@ -439,28 +634,44 @@ class UI:
         # Perform a dissolve-type transition from the current HAT display
         # contents to that of pixel array *new_display*.
 
-        orig_display = self._get_display()
-        for step in range(self.fade_animation_steps):
-            new_display_opacity = (step + 1) / self.fade_animation_steps
-            display = np.rint(
-                orig_display * (1 - new_display_opacity)
-                + new_display * new_display_opacity
-            ).astype(np.uint8)
-            self._set_display(display)
+        if np.array_equal(self._current_display, new_display):
+            return
+
+        # Blend every frame up front in integer arithmetic: frame
+        # *step* of *steps* is (orig × (steps − step) + new × step) /
+        # steps, rounded.  The loop below then only has to send them.
+        # 32 bits leave room for any practical number of steps.
+        steps = self.fade_animation_steps
+        weights = np.arange(1, steps + 1, dtype=np.uint32).reshape(
+            -1, 1, 1, 1)
+        frames = self._current_display.astype(np.uint32) * (steps - weights)
+        frames += np.asarray(new_display, dtype=np.uint32) * weights
+        frames += steps // 2
+        frames //= steps
+        packed_frames = (
+            [None] * steps if self._framebuffer is None
+            else self._rgb565(frames))
+        for frame, packed in zip(frames, packed_frames):
+            self._set_display(frame, packed)
             time.sleep(self.animation_rate)
 
     def _fade_dots(self):
         # Turn off all pixels on the HAT in a shuffled sequence
-        coords = list([(x // 8, x % 8) for x in range(64)])
-        random.shuffle(coords)
-        for coord in coords:
-            self._hat.set_pixel(*coord, (0, 0, 0))
+        display = self._current_display.copy()
+        pixels = display.reshape(-1, 3)
+        order = np.random.permutation(len(pixels))
+        for start in range(0, len(order), self.fade_dots_per_frame):
+            pixels[order[start:start + self.fade_dots_per_frame]] = 0
+            self._set_display(display)
             time.sleep(self.animation_rate)
 
     def _flash(self, times=2):
         # Briefly flash the screen
-        for _ in range(times * 2):
-            self._fade_to((255, 255, 255) - self._get_display())
+        display = self._current_display.copy()
+        inverted_display = 255 - display
+        for _ in range(times):
+            self._fade_to(inverted_display)
+            self._fade_to(display)
 
 
 def main():
@@ -473,6 +684,8 @@ def main():
     except KeyboardInterrupt:
         hat.clear()
         print()
+    finally:
+        ui.close()
 
 
 if __name__ == '__main__':